@@ -5,36 +5,70 @@ Generate the images and rst files for gallery of SfePy examples.
 The following steps need to be made to regenerate the documentation with the
 updated example files:
 
-1. remove doc/examples/*::
-
-   $ rm -rf doc/examples/*
-
-2. generate the files:
+1. generate the files::
 
    $ ./script/gen_gallery.py
 
-3. regenerate the documentation::
+2. regenerate the documentation::
 
    $ python setup.py htmldocs
+
+Only the examples whose source, custom views in this script or the SfePy
+version changed are solved again. This is decided by the manifests
+`.gallery_manifest.json` (successful examples) and `.gallery_failures.json`
+(failed examples) in doc/images/gallery/. Note that in a git source tree, the
+SfePy version includes the current commit hash (e.g. ``2020.1+git.<hash>``),
+so any new commit, even a docs-only one, invalidates all the cached images
+and failures. An example is also solved again, if any of its images
+is missing. To ignore the manifests and solve all examples, including those
+that failed previously, use::
+
+   $ ./script/gen_gallery.py --force
+
+The rst files in doc/examples/ are regenerated if the example, the templates
+or the included images change, as recorded in
+doc/examples/.rst_manifest.json. Remove doc/examples/* to regenerate all of
+them.
+
+The thumbnails are resized using Pillow, if available, otherwise
+matplotlib is used. For the fastest resizing, install `pillow-simd` (built
+with AVX2 support) in place of `pillow`::
+
+   $ pip uninstall pillow
+   $ CC="cc -mavx2" pip install -U --force-reinstall pillow-simd
 """
 from __future__ import absolute_import
 import sys
 import six
 sys.path.append('.')
 import os
+import shutil
 import tempfile
-import glob
 import re
+import json
+import hashlib
+import errno
+import traceback
+import inspect
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
 
-import matplotlib.image as image
+try:
+    from PIL import Image
+
+except ImportError:
+    Image = None
 
 import sfepy
 from sfepy.base.base import (get_default, ordered_iteritems,
                              import_file, output, Struct)
-from sfepy.base.ioutils import (ensure_path, locate_files, remove_files,
-                                edit_filename)
-from sfepy.postprocess.domain_specific import DomainSpecificPlot
+from sfepy.base.ioutils import ensure_path, edit_filename
+
+_SEP = os.path.sep
+_DATA_DIR = sfepy.data_dir
+_DATA_DIR_LEN = len(_DATA_DIR)
 
 omits = [
     'vibro_acoustic3d_mid.py',
@@ -43,10 +77,14 @@ omits = [
     '__init__.py',
 ]
 
+default_views = {'' : {'is_scalar_bar' : True}}
+
 omit_dirs = [
     re.compile('.*output.*/').match,
 ]
 
+# The domain-specific plots are given as (function name, arguments) pairs,
+# see _make_views().
 custom = {
     'acoustics/acoustics3d.py' : {
         '_p_1' : {
@@ -87,8 +125,8 @@ custom = {
             'is_scalar_bar' : True,
             'is_wireframe' : True,
             'domain_specific' : {
-                't' : DomainSpecificPlot('plot_warp_scalar',
-                                          ['rel_scaling=1']),
+                't' : ('plot_warp_scalar',
+                       ['rel_scaling=1']),
             },
             'view' : (-90, 90, 1.5, [0,  0, 0]),
             'roll' : 0,
@@ -100,10 +138,10 @@ custom = {
             'is_scalar_bar' : True,
             'is_wireframe' : True,
             'domain_specific' : {
-                'u1' : DomainSpecificPlot('plot_warp_scalar',
-                                          ['rel_scaling=1']),
-                'u2' : DomainSpecificPlot('plot_warp_scalar',
-                                          ['rel_scaling=1']),
+                'u1' : ('plot_warp_scalar',
+                        ['rel_scaling=1']),
+                'u2' : ('plot_warp_scalar',
+                        ['rel_scaling=1']),
             },
             'view' : (-82, 50, 3.6, [-0.43, -0.55, 0.4]),
             'roll' : -23,
@@ -115,8 +153,8 @@ custom = {
             'is_scalar_bar' : True,
             'is_wireframe' : True,
             'domain_specific' : {
-                't' : DomainSpecificPlot('plot_warp_scalar',
-                                         ['rel_scaling=1']),
+                't' : ('plot_warp_scalar',
+                       ['rel_scaling=1']),
             },
             'view' : (55, 39, 6.6, [-0.35, -0.29, 0.35]),
             'roll' : 15,
@@ -128,8 +166,8 @@ custom = {
             'is_scalar_bar' : True,
             'is_wireframe' : True,
             'domain_specific' : {
-                't' : DomainSpecificPlot('plot_warp_scalar',
-                                         ['rel_scaling=1']),
+                't' : ('plot_warp_scalar',
+                       ['rel_scaling=1']),
             },
             'view' : (-170, 30, 4.7, [0.34, 0.23, -0.26]),
             'roll' : 71,
@@ -147,8 +185,8 @@ custom = {
             'is_scalar_bar' : True,
             'is_wireframe' : True,
             'domain_specific' : {
-                'u' : DomainSpecificPlot('plot_displacements',
-                                         ['rel_scaling=1']),
+                'u' : ('plot_displacements',
+                       ['rel_scaling=1']),
             },
             'view' : (-82, 47, 3.4, [-0.5, -0.24, -0.2]),
             'roll' : -8.4,
@@ -160,8 +198,8 @@ custom = {
             'is_scalar_bar' : True,
             'is_wireframe' : True,
             'domain_specific' : {
-                'u' : DomainSpecificPlot('plot_displacements',
-                                         ['rel_scaling=1']),
+                'u' : ('plot_displacements',
+                       ['rel_scaling=1']),
             },
             'view' : (-82, 47, 3.4, [-0.5, -0.24, -0.2]),
             'roll' : -8.4,
@@ -174,10 +212,10 @@ custom = {
             'is_wireframe' : True,
             'only_names' : ['u'],
             'domain_specific' : {
-                'u' : DomainSpecificPlot('plot_displacements',
-                                         ['rel_scaling=1',
-                                          'color_kind="scalars"',
-                                          'color_name="von_mises_stress"']),
+                'u' : ('plot_displacements',
+                       ['rel_scaling=1',
+                        'color_kind="scalars"',
+                        'color_name="von_mises_stress"']),
             },
             'view' : (142, 39, 16, [-4.7, -2.1, -1.9]),
             'roll' : 8.4,
@@ -189,8 +227,8 @@ custom = {
             'is_scalar_bar' : True,
             'is_wireframe' : True,
             'domain_specific' : {
-                'u' : DomainSpecificPlot('plot_displacements',
-                                         ['rel_scaling=1']),
+                'u' : ('plot_displacements',
+                       ['rel_scaling=1']),
             },
             'view' : (-37, 51, 1.5, [-0.28, -0.29, 0.0]),
             'roll' : -51.5,
@@ -202,8 +240,8 @@ custom = {
             'is_scalar_bar' : True,
             'is_wireframe' : True,
             'domain_specific' : {
-                'u_disp' : DomainSpecificPlot('plot_displacements',
-                                              ['rel_scaling=1']),
+                'u_disp' : ('plot_displacements',
+                            ['rel_scaling=1']),
             },
             'view' : (-45, 81, 0.59, [-0.075,  0.023,  0.093]),
             'roll' : -75.0,
@@ -236,10 +274,10 @@ custom = {
             'is_wireframe' : True,
             'only_names' : ['u'],
             'domain_specific' : {
-                'u' : DomainSpecificPlot('plot_displacements',
-                                         ['rel_scaling=1000',
-                                          'color_kind="scalars"',
-                                          'color_name="T"']),
+                'u' : ('plot_displacements',
+                       ['rel_scaling=1000',
+                        'color_kind="scalars"',
+                        'color_name="T"']),
             },
             'view' : (-51, 71, 12.9, [-2.3, -2.4, -0.2]),
             'roll' : -65,
@@ -296,6 +334,34 @@ def _omit(filename):
     return omit
 
 
+def _scan_py(root):
+    """
+    Yield paths to all Python files in and below the `root` directory.
+
+    Uses `os.scandir()`, so that the file types are taken from the cached
+    directory entries without a stat call per entry.
+    """
+    stack = [root]
+    while stack:
+        dirname = stack.pop()
+        with os.scandir(dirname) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+
+                elif entry.name.endswith('.py') and entry.is_file():
+                    yield entry.path
+
+
+def _scan_png(dirname):
+    """
+    Return paths to all PNG images in the `dirname` directory.
+    """
+    with os.scandir(dirname) as it:
+        return [entry.path for entry in it
+                if entry.name.endswith('.png') and entry.is_file()]
+
+
 def ebase2fbase(ebase):
     return os.path.splitext(ebase)[0].replace(os.path.sep, '-')
 
@@ -318,32 +384,144 @@ def _get_fig_filename(ebase, images_dir, suffix):
 
 
 def _make_sphinx_path(path, relative=False):
+    if path.startswith(_DATA_DIR):
+        aux = path[_DATA_DIR_LEN:]
+        root = '/..'
+
+    else:
+        aux = path
+        root = ''
+
     if relative:
-        aux = path.replace(sfepy.data_dir, '')
         prefix = ('..' + os.path.sep) * aux.count(os.path.sep)
         sphinx_path = prefix[:-1] + aux
 
     else:
-        sphinx_path = path.replace(sfepy.data_dir, '/..')
+        sphinx_path = root + aux
 
     return sphinx_path
 
-def generate_images(images_dir, examples_dir):
+def _load_manifest(filename):
+    """
+    Load a JSON manifest from `filename`. Return an empty dict if the file
+    does not exist or cannot be parsed.
+    """
+    try:
+        with open(filename, 'r') as fd:
+            manifest = json.load(fd)
+
+    except (IOError, ValueError):
+        manifest = {}
+
+    return manifest
+
+def _save_manifest(filename, manifest):
+    """
+    Save a JSON `manifest` to `filename`.
+    """
+    with open(filename, 'w') as fd:
+        json.dump(manifest, fd, indent=1, sort_keys=True)
+
+def _get_views_sha(ebase):
+    """
+    Return the SHA256 hex digest of the views used to render the example
+    `ebase`.
+    """
+    views = custom.get(ebase, default_views)
+    return hashlib.sha256(repr(sorted(views.items())).encode()).hexdigest()
+
+def _get_src_sha(filename):
+    """
+    Return the SHA256 hex digest of the contents of `filename`.
+    """
+    with open(filename, 'rb') as fd:
+        return hashlib.sha256(fd.read()).hexdigest()
+
+def _is_cacheable_error(exc):
+    """
+    Return False if `exc`, or any exception it was raised from, is an
+    out-of-space error. A solve can fail this way whenever the temporary
+    directory or the disk quota runs out, e.g. on a shared CI machine. Such
+    errors depend on the environment, not on the example, and must not be
+    recorded as failures of the example.
+    """
+    while exc is not None:
+        if (isinstance(exc, OSError)
+            and exc.errno in (errno.ENOSPC, errno.EDQUOT)):
+            return False
+
+        exc = exc.__cause__ or exc.__context__
+
+    return True
+
+def _make_views(views):
+    """
+    Return a copy of `views` with the domain-specific plots given as
+    (function name, arguments) pairs replaced by `DomainSpecificPlot`
+    instances. This postpones importing Mayavi until an example is rendered.
+    """
+    from sfepy.postprocess.domain_specific import DomainSpecificPlot
+
+    out = {}
+    for suffix, kwargs in six.iteritems(views):
+        kwargs = kwargs.copy()
+        if 'domain_specific' in kwargs:
+            kwargs['domain_specific'] = {
+                name : DomainSpecificPlot(*val)
+                for name, val in six.iteritems(kwargs['domain_specific'])
+            }
+        out[suffix] = kwargs
+
+    return out
+
+_viewer = None
+
+def _get_viewer():
+    """
+    Return the viewer of the current (worker) process. On the first call,
+    create the viewer together with its figure, that is then reused for all
+    examples solved by the process.
     """
-    Generate images from results of running examples found in
-    `examples_dir` directory.
+    global _viewer
+
+    if _viewer is None:
+        from sfepy.postprocess.viewer import Viewer
+        from sfepy.postprocess.utils import mlab
 
-    The generated images are stored to `images_dir`,
+        _viewer = Viewer('', offscreen=False)
+        _viewer.scene = mlab.figure(fgcolor=(0.0, 0.0, 0.0),
+                                    bgcolor=(1.0, 1.0, 1.0),
+                                    size=_viewer.get_size_hint('rowcol'))
+
+    return _viewer
+
+def _solve_and_render(ex_filename, iex, images_dir, examples_dir,
+                      output_dir):
+    """
+    Solve a single example and render its results to `images_dir`.
+
+    The function is run in a worker process. The results are saved in
+    `output_dir` using a trunk unique for the example number `iex`, and are
+    not removed here. The viewer and its figure are shared by all calls in
+    the process, see `_get_viewer()`.
+
+    Returns
+    -------
+    status : tuple
+        The tuple of the example base name, a list of the generated figure
+        file names, an error message and a flag telling whether the failure
+        can be cached. If the example failed, the list is None, otherwise
+        the error message is None. Only solve failures can be cached.
     """
+    global _viewer
+
     from sfepy.applications import solve_pde
-    from sfepy.postprocess.viewer import Viewer
     from sfepy.postprocess.utils import mlab
     from sfepy.solvers.ts_solvers import StationarySolver
 
     prefix = output.prefix
 
-    output_dir = tempfile.mkdtemp()
-    trunk = os.path.join(output_dir, 'result')
+    trunk = os.path.join(output_dir, 'result_%d' % iex)
     options = Struct(output_filename_trunk=trunk,
                      output_format='vtk',
                      save_ebc=False,
@@ -352,125 +530,269 @@ def generate_images(images_dir, examples_dir):
                      save_field_meshes=False,
                      save_regions_as_groups=False,
                      solve_not=False)
-    default_views = {'' : {'is_scalar_bar' : True}}
+    output.level = 0
+    output.prefix = prefix
+    ebase = ex_filename.replace(examples_dir, '')[1:]
+    output('trying "%s"...' % ebase)
 
-    ensure_path(images_dir + os.path.sep)
+    try:
+        problem, state = solve_pde(ex_filename, options=options)
 
-    view = Viewer('', offscreen=False)
+    except Exception as exc:
+        output.prefix = prefix
+        output(traceback.format_exc())
+        output('***** failed! *****')
+        return ebase, None, repr(exc), _is_cacheable_error(exc)
 
-    for ex_filename in locate_files('*.py', examples_dir):
-        if _omit(ex_filename): continue
+    output.prefix = prefix
 
-        output.level = 0
-        output.prefix = prefix
-        ebase = ex_filename.replace(examples_dir, '')[1:]
-        output('trying "%s"...' % ebase)
+    if ebase in custom:
+        views = _make_views(custom[ebase])
+
+    else:
+        views = default_views
+
+    try:
+        tsolver = problem.get_solver()
+
+    except ValueError:
+        suffix = None
+
+    else:
+        if isinstance(tsolver, StationarySolver):
+            suffix = None
 
+        else:
+            suffix = tsolver.ts.suffix % (tsolver.ts.n_step - 1)
+
+    fig_filenames = []
+    filename = problem.get_output_name(suffix=suffix)
+    try:
+        view = _get_viewer()
+        for suffix, kwargs in six.iteritems(views):
+            fig_filename = _get_fig_filename(ebase, images_dir, suffix)
+
+            fname = edit_filename(filename, suffix=suffix)
+            output('displaying results from "%s"' % fname)
+            disp_name = fig_filename.replace(sfepy.data_dir, '')
+            output('to "%s"...' % disp_name.lstrip(os.path.sep))
+
+            view.filename = fname
+            view(scene=view.scene, show=False, **kwargs)
+            view.save_image(fig_filename)
+            mlab.clf(view.scene)
+            fig_filenames.append(fig_filename)
+
+            output('...done')
+
+    except Exception as exc:
+        output(traceback.format_exc())
+        output('***** rendering failed! *****')
+        # Clear the shared scene or, if that fails, start a new viewer for
+        # the next example.
         try:
-            problem, state = solve_pde(ex_filename, options=options)
+            if _viewer is not None:
+                mlab.clf(_viewer.scene)
 
-        except KeyboardInterrupt:
-            raise
+        except Exception:
+            _viewer = None
 
-        except:
-            problem = None
-            output('***** failed! *****')
+        # Rendering errors usually come from the environment (display,
+        # GL/VTK context), not from the example, so they are not cached.
+        return ebase, None, repr(exc), False
 
-        if problem is not None:
-            if ebase in custom:
-                views = custom[ebase]
+    return ebase, fig_filenames, None, True
 
-            else:
-                views = default_views
+def generate_images(images_dir, examples_dir, ex_filenames, n_workers=None,
+                    force=False, tmp_dir=None):
+    """
+    Generate images from results of running examples `ex_filenames` found
+    in `examples_dir` directory.
+
+    The examples are solved in parallel by `n_workers` processes (all
+    available CPUs by default). The generated images are stored to
+    `images_dir`. The temporary results of examples are saved in a new
+    directory in `tmp_dir` (the default temporary directory if None), that
+    is removed after all examples are processed.
+
+    Examples whose source, views and the SfePy version did not change since
+    the last successful run, as recorded in
+    `images_dir/.gallery_manifest.json`, and whose images exist, are
+    skipped. Similarly, examples that failed in a previous run, as recorded
+    in `images_dir/.gallery_failures.json`, are skipped unless their source
+    or the SfePy version changed. Failures
+    caused by a lack of space are not recorded. If `force` is True, both
+    manifests are ignored and all examples are solved.
+    """
+    ensure_path(images_dir + os.path.sep)
 
-            try:
-                tsolver = problem.get_solver()
+    manifest_filename = os.path.join(images_dir, '.gallery_manifest.json')
+    manifest = _load_manifest(manifest_filename)
+    failures_filename = os.path.join(images_dir, '.gallery_failures.json')
+    failures = _load_manifest(failures_filename)
 
-            except ValueError:
-                suffix = None
+    todo = []
+    entries = {}
+    for ex_filename in ex_filenames:
+        ebase = ex_filename.replace(examples_dir, '')[1:]
+        fig_base = ebase2fbase(ebase)
+        src_sha = _get_src_sha(ex_filename)
+        entry = {'src_sha' : src_sha, 'sfepy_ver' : sfepy.__version__,
+                 'views_sha' : _get_views_sha(ebase)}
+        if not force:
+            if ((manifest.get(fig_base) == entry)
+                and all(os.path.exists(fig_filename) for fig_filename
+                        in _get_fig_filenames(ebase, images_dir))):
+                output('"%s" is up to date' % ebase)
+                continue
 
-            else:
-                if isinstance(tsolver, StationarySolver):
-                    suffix = None
+            failure = failures.get(fig_base, {})
+            if ((failure.get('src_sha') == src_sha)
+                and (failure.get('sfepy_ver') == sfepy.__version__)):
+                output('"%s" failed previously, skipping (%s)'
+                       % (ebase, failure.get('error')))
+                continue
+
+        todo.append(ex_filename)
+        entries[ebase] = entry
+
+    if not todo:
+        output('...all images are up to date')
+        return
+
+    output_dir = tempfile.mkdtemp(dir=tmp_dir)
+    worker = partial(_solve_and_render, images_dir=images_dir,
+                     examples_dir=examples_dir, output_dir=output_dir)
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            statuses = executor.map(worker, todo, range(len(todo)))
+            for ebase, fig_filenames, error, is_cacheable in statuses:
+                fig_base = ebase2fbase(ebase)
+                entry = entries[ebase].copy()
+                if fig_filenames is None and not is_cacheable:
+                    output('"%s" failed, not recording the failure! (%s)'
+                           % (ebase, error))
+
+                elif fig_filenames is None:
+                    output('"%s" failed! (%s)' % (ebase, error))
+                    entry['error'] = error
+                    failures[fig_base] = entry
+                    _save_manifest(failures_filename, failures)
 
                 else:
-                    suffix = tsolver.ts.suffix % (tsolver.ts.n_step - 1)
+                    output('"%s": %d image(s)' % (ebase, len(fig_filenames)))
+                    manifest[fig_base] = entry
+                    _save_manifest(manifest_filename, manifest)
+                    if failures.pop(fig_base, None) is not None:
+                        _save_manifest(failures_filename, failures)
 
-            filename = problem.get_output_name(suffix=suffix)
-            for suffix, kwargs in six.iteritems(views):
-                fig_filename = _get_fig_filename(ebase, images_dir, suffix)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
 
-                fname = edit_filename(filename, suffix=suffix)
-                output('displaying results from "%s"' % fname)
-                disp_name = fig_filename.replace(sfepy.data_dir, '')
-                output('to "%s"...' % disp_name.lstrip(os.path.sep))
+    output('...done')
 
-                view.filename = fname
-                view(scene=view.scene, show=False, **kwargs)
-                view.save_image(fig_filename)
-                mlab.clf()
+def _thumbnail_pil(src, dst, scale):
+    """
+    Save the image `src` scaled by `scale` to `dst` using Pillow.
+    """
+    resampling = getattr(Image, 'Resampling', Image)
+    with Image.open(src) as im:
+        im.thumbnail((int(im.width * scale), int(im.height * scale)),
+                     resampling.LANCZOS)
+        im.save(dst, optimize=True)
 
-                output('...done')
+def _one_thumb(args):
+    """
+    Generate a single thumbnail. Unpacks `args` for use with
+    `multiprocessing.Pool.imap_unordered()`.
+    """
+    fig_filename, thumb_filename, scale = args
+    if Image is not None:
+        _thumbnail_pil(fig_filename, thumb_filename, scale)
 
-            remove_files(output_dir)
+    else:
+        import matplotlib.image as image
+        image.thumbnail(fig_filename, thumb_filename, scale=scale)
 
-        output('...done')
+    return fig_filename
 
-def generate_thumbnails(thumbnails_dir, images_dir, scale=0.3):
+def generate_thumbnails(thumbnails_dir, fig_filenames, scale=0.3,
+                        n_workers=None):
     """
-    Generate thumbnails into `thumbnails_dir` corresponding to images in
-    `images_dir`.
+    Generate thumbnails into `thumbnails_dir` corresponding to images
+    `fig_filenames`, using `n_workers` processes (all available CPUs by
+    default).
     """
     ensure_path(thumbnails_dir + os.path.sep)
 
     output('generating thumbnails...')
-    filenames = glob.glob(os.path.join(images_dir, '*.png'))
-    for fig_filename in filenames:
-        ebase = fig_filename.replace(sfepy.data_dir, '').lstrip(os.path.sep)
-        output('"%s"' % ebase)
-
+    tasks = []
+    for fig_filename in fig_filenames:
         base = os.path.basename(fig_filename)
         thumb_filename = os.path.join(thumbnails_dir, base)
+        tasks.append((fig_filename, thumb_filename, scale))
 
-        image.thumbnail(fig_filename, thumb_filename, scale=scale)
+    with multiprocessing.Pool(processes=n_workers) as pool:
+        for fig_filename in pool.imap_unordered(_one_thumb, tasks,
+                                                chunksize=8):
+            ebase = fig_filename.replace(sfepy.data_dir, '')
+            output('"%s"' % ebase.lstrip(os.path.sep))
 
     output('...done')
 
-_index = """\
-.. _%s-index:
+def _render_index(label, title):
+    underline = '=' * len(title)
+    return f"""\
+.. _{label}-index:
 
-%s
-%s
+{title}
+{underline}
 
 .. toctree::
    :maxdepth: 2
 
 """
 
-_image = '.. image:: %s'
+def _render_image(rst_fig_filename):
+    return f'.. image:: {rst_fig_filename}\n'
 
-_include = """\
-.. _%s:
+def _render_include(rst_base, ebase, docstring, fig_include,
+                    rst_ex_filename):
+    underline = '=' * len(ebase)
+    return f"""\
+.. _{rst_base}:
 
-%s
-%s
+{ebase}
+{underline}
 
 **Description**
 
-%s
+{docstring}
 
-%s
+{fig_include}
 
-:download:`source code <%s>`
+:download:`source code <{rst_ex_filename}>`
 
-.. literalinclude:: %s
+.. literalinclude:: {rst_ex_filename}
 
 """
 
-def generate_rst_files(rst_dir, examples_dir, images_dir):
+def _write_one(filename, content):
+    """
+    Write `content` to `filename` with a single call.
+    """
+    with open(filename, 'w') as fd:
+        fd.write(content)
+
+def generate_rst_files(rst_dir, examples_dir, images_dir, ex_filenames):
     """
-    Generate Sphinx rst files for examples in `examples_dir` with images
-    in `images_dir` and put them into `rst_dir`.
+    Generate Sphinx rst files for examples `ex_filenames` in `examples_dir`
+    with images in `images_dir` and put them into `rst_dir`.
+
+    An example rst file is not regenerated, if it exists and the example
+    modification time and size, the rst templates and the included images
+    did not change since the last run, as recorded in
+    `rst_dir/.rst_manifest.json`.
 
     Returns
     -------
@@ -482,9 +804,7 @@ def generate_rst_files(rst_dir, examples_dir, images_dir):
     output('generating rst files...')
 
     dir_map = {}
-    for ex_filename in locate_files('*.py', examples_dir):
-        if _omit(ex_filename): continue
-
+    for ex_filename in ex_filenames:
         ebase = ex_filename.replace(examples_dir, '')[1:]
         base_dir = os.path.dirname(ebase)
         rst_filename = ebase2fbase(ebase) + '.rst'
@@ -494,50 +814,73 @@ def generate_rst_files(rst_dir, examples_dir, images_dir):
         filenames = sorted(filenames, key=lambda a: a[1])
         dir_map[dirname] = filenames
 
+    manifest_filename = os.path.join(rst_dir, '.rst_manifest.json')
+    manifest = _load_manifest(manifest_filename)
+    # Hash the template functions source to detect their changes.
+    templates = (inspect.getsource(_render_include)
+                 + inspect.getsource(_render_image))
+    template_sha = hashlib.sha256(templates.encode()).hexdigest()
+
+    rst_files = []
+
     # Main index.
-    mfd = open(os.path.join(rst_dir, 'index.rst'), 'w')
-    mfd.write(_index % ('examples', 'Examples', '=' * 8))
+    mlines = [_render_index('examples', 'Examples')]
 
     for dirname, filenames in ordered_iteritems(dir_map):
         # Subdirectory index.
-        ifd = open(os.path.join(rst_dir, '%s-index.rst' % dirname), 'w')
-        ifd.write(_index % (dirname + '-examples',
-                            dirname, '=' * len(dirname)))
+        ilines = [_render_index(dirname + '-examples', dirname)]
 
         for ex_filename, rst_filename in filenames:
-            full_rst_filename = os.path.join(rst_dir, rst_filename)
+            full_rst_filename = rst_dir + _SEP + rst_filename
             output('"%s"' % rst_filename)
             ebase = ex_filename.replace(examples_dir, '')[1:]
 
             rst_base = os.path.splitext(rst_filename)[0]
 
-            rst_ex_filename = _make_sphinx_path(ex_filename)
-            docstring = get_default(import_file(ex_filename).__doc__,
-                                    'missing description!')
-
-            ifd.write('   %s <%s>\n' % (os.path.basename(ebase), rst_base))
+            ilines.append('   %s <%s>\n' % (os.path.basename(ebase), rst_base))
             fig_include = ''
             for fig_filename in _get_fig_filenames(ebase, images_dir):
                 rst_fig_filename = _make_sphinx_path(fig_filename)
                 if os.path.exists(fig_filename):
-                    fig_include += _image % rst_fig_filename + '\n'
+                    fig_include += _render_image(rst_fig_filename)
                 else:
                     output('   warning: figure "%s" not found' % fig_filename)
 
+            key = [os.path.getmtime(ex_filename),
+                   os.path.getsize(ex_filename),
+                   template_sha, fig_include]
+            if ((manifest.get(rst_filename) == key)
+                and os.path.exists(full_rst_filename)):
+                continue
+
+            manifest[rst_filename] = key
+
+            rst_ex_filename = _make_sphinx_path(ex_filename)
+            docstring = get_default(import_file(ex_filename).__doc__,
+                                    'missing description!')
 
             # Example rst file.
-            fd = open(full_rst_filename, 'w')
-            fd.write(_include % (rst_base, ebase, '=' * len(ebase),
-                                 docstring,
-                                 fig_include,
-                                 rst_ex_filename, rst_ex_filename))
-            fd.close()
+            content = _render_include(rst_base, ebase, docstring, fig_include,
+                                      rst_ex_filename)
+            rst_files.append((full_rst_filename, content))
+
+        rst_files.append((os.path.join(rst_dir, '%s-index.rst' % dirname),
+                          ''.join(ilines)))
+
+        mlines.append('   %s-index\n' % dirname)
 
-        ifd.close()
+    rst_files.append((os.path.join(rst_dir, 'index.rst'), ''.join(mlines)))
 
-        mfd.write('   %s-index\n' % dirname)
+    # Create the directories first, so that the writer threads do not race.
+    for dirname in set(os.path.dirname(filename)
+                       for filename, _ in rst_files):
+        ensure_path(dirname + os.path.sep)
 
-    mfd.close()
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        for _ in executor.map(lambda fc: _write_one(*fc), rst_files):
+            pass
+
+    _save_manifest(manifest_filename, manifest)
 
     output('...done')
 
@@ -645,6 +988,13 @@ def generate_gallery(examples_dir, output_filename, doc_dir,
 helps = {
     'doc_dir': 'top level directory of gallery files',
     'no_images': 'do not (re)generate images and thumbnails',
+    'tmp_dir': 'the directory for temporary results of examples, e.g.'
+    ' a RAM-backed /dev/shm with enough free space'
+    ' [default: the system temporary directory]',
+    'force': 'solve all examples, ignoring the manifests of up-to-date and'
+    ' failed examples in the images directory',
+    'n_workers': 'the number of worker processes used to generate images'
+    ' and thumbnails [default: the number of CPUs]',
     'output_filename': 'output file name [default: %(default)s]',
 }
 
@@ -658,6 +1008,15 @@ def main():
     parser.add_argument('-n', '--no-images',
                         action='store_true', dest='no_images',
                         default=False, help=helps['no_images'])
+    parser.add_argument('-f', '--force',
+                        action='store_true', dest='force',
+                        default=False, help=helps['force'])
+    parser.add_argument('-t', '--tmp-dir', metavar='tmp_dir',
+                        action='store', dest='tmp_dir',
+                        default=None, help=helps['tmp_dir'])
+    parser.add_argument('-j', '--n-workers', metavar='n_workers', type=int,
+                        action='store', dest='n_workers',
+                        default=None, help=helps['n_workers'])
     parser.add_argument('-o', '--output', metavar='output_filename',
                         action='store', dest='output_filename',
                         default='gallery.rst',
@@ -673,11 +1032,18 @@ def main():
 
     output_filename = os.path.join(full_rst_dir, options.output_filename)
 
-    if not options.no_images:
-        generate_images(images_dir, examples_dir)
-        generate_thumbnails(thumbnails_dir, images_dir)
+    ex_filenames = [ex_filename for ex_filename in _scan_py(examples_dir)
+                    if not _omit(ex_filename)]
 
-    dir_map = generate_rst_files(full_rst_dir, examples_dir, images_dir)
+    if not options.no_images:
+        generate_images(images_dir, examples_dir, ex_filenames,
+                        n_workers=options.n_workers, force=options.force,
+                        tmp_dir=options.tmp_dir)
+        generate_thumbnails(thumbnails_dir, _scan_png(images_dir),
+                            n_workers=options.n_workers)
+
+    dir_map = generate_rst_files(full_rst_dir, examples_dir, images_dir,
+                                 ex_filenames)
 
     generate_gallery(examples_dir, output_filename, doc_dir,
                      rst_dir, thumbnails_dir, dir_map)